@@ -1,49 +1,69 @@
 import numpy as np
+from glob import glob
+import matplotlib
+matplotlib.use("Agg")   # Only writing files, no need for an interactive backend
 import matplotlib.pyplot as plt
-from scipy import optimize
 
 data_path = "./data/"
 plots_path = "./plots/"
 sizes_to_plot = [10, 16, 24, 36]
 
+plt.rcParams["path.simplify"] = True
+plt.rcParams["agg.path.chunksize"] = 10000
+
 # Helpers ================================
 
 def critical_values(T, X):
-    # We get some outliers near T = 0, so use this to ignore those
-    peak_window = (T > 1.5) & (T < 3.5)
+    # We get some outliers near T = 0, so use this to ignore those. T is sorted, 
+    # so the window 1.5 < T < 3.5 is just a slice (a view, no copies)
+    lo = np.searchsorted(T, 1.5, side="right")
+    hi = np.searchsorted(T, 3.5, side="left")
 
     # Find T of peak, peak value, and return
-    T, X = T[peak_window], X[peak_window]
-    peak = np.argmax(X)
-    return T[peak], X[peak]
+    peak = lo + np.argmax(X[lo:hi])
+    return float(T[peak]), float(X[peak])
 
 def fit_line(xx, yy):
-    try:
-        guess_m = (yy[1]-yy[0])/(xx[1]-xx[0])
-        guess_b = 0
-        guess = np.array([guess_m, guess_b])
+    if len(xx) < 2:
+        print("!! Fit set to zeros !!")
+        return(0, 0, 0, 0, 0)
 
-        lin = lambda x, m, b: m*x + b
+    # Linear least squares has a closed form, no need for an iterative fit.
+    # Estimating the covariance needs at least 3 points
+    if len(xx) > 2: (m, b), pcov = np.polyfit(xx, yy, 1, cov=True)
+    else: (m, b), pcov = np.polyfit(xx, yy, 1), np.full((2, 2), np.inf)
 
-        popt, pcov = optimize.curve_fit(lin, xx, yy, p0 = guess)
-        m, b = popt
-        dm, db = pcov[0][0], pcov[1][1]
-        fit_func = lin(xx, m, b)
-
-    except IndexError:
-        guess_m = 0
-        m, b, dm, db, fit_func = 0, 0, 0, 0, 0
-        print("!! Fit set to zeros !!")
+    dm, db = pcov[0][0], pcov[1][1]
+    fit_func = m*np.asarray(xx) + b
 
     return(m, b, dm, db, fit_func)
 
-# See https://stackoverflow.com/a/28766902
 def find_intersection(x, y1, y2):
-    idx = np.argwhere(np.diff(np.sign(y1 - y2))).flatten()
-    return x[idx], y1[idx], y2[idx]
+    # Points where y1 - y2 changes sign, then interpolate linearly between the
+    # neighboring samples to get the crossing itself. A sample where the curves just
+    # touch only counts if the sign really changes across it, so curves that coincide
+    # have no crossings at all
+    d = y1 - y2
+    strict = np.nonzero(d[:-1]*d[1:] < 0)[0]
+    touch = np.nonzero((d[1:-1] == 0) & (d[:-2]*d[2:] < 0))[0] + 1
+    idx = np.sort(np.concatenate((strict, touch)))
+
+    d0, d1 = d[idx], d[idx+1]
+    t = d0/(d0 - d1)    # Never 0/0: d1 != 0 both for sign changes and for touches
+
+    xc = x[idx] + t*(x[idx+1] - x[idx])
+    yc = y1[idx] + t*(y1[idx+1] - y1[idx])
+    return xc, yc, yc
+
+def save(fig, name):
+    # Lay out once and write both formats
+    fig.tight_layout()
+    fig.savefig(plots_path + f"{name}.pdf")
+    fig.savefig(plots_path + f"{name}.png")
 
 def numerical_integrate(f, dx):
-    return np.cumsum(f*dx)
+    # Uniform grid, so scale once after summing
+    return np.cumsum(f)*dx
 
 # =========================================
 
@@ -52,6 +72,9 @@ class Plotter:
     def __init__(self, sizes_to_plot):
         self.sizes, self.results = self._read_results(sizes_to_plot)
 
+        # Every plot reuses the same figure, building a new one each time is slow
+        self.fig, self.ax = plt.subplots()
+
         # Cosmetic parameters
         self.markers = ["D", "^", "v", "o"]
         self.colors = ["g", "r", "b", "k"]
@@ -61,22 +84,55 @@ class Plotter:
         self.variables = ["E", "M", "C", "Chi"]
         self.labels = [r"$E/N$", "$M$", "$C_V$", "$\chi$"]
 
+        # Temperature step of each (uniform) grid, used for integrating
+        self.dT = {L: self.results[L]["T"][1] - self.results[L]["T"][0] for L in self.sizes}
+
+        # Entropy S(T) = int C/T dT, shared by the entropy and free energy plots
+        self.S = {L: numerical_integrate(self.results[L]["C"]/self.results[L]["T"], self.dT[L]) for L in self.sizes}
+
+        # Critical values are shared by most plots, so only compute them once
+        self.beta_nu = 0.25
+        self.peaks = {variable: {L: critical_values(self.results[L]["T"], self.results[L][variable]) for L in self.sizes} 
+                      for variable in ["C", "Chi"]}
+
+        log_L = np.log(self.sizes)
+        log_Xc = np.log([self.peaks["Chi"][L][1] for L in self.sizes])
+        self.gamma_nu_fit = fit_line(log_L, log_Xc)
+
+        # T_c from where L^(beta/nu) M of the smallest and largest sizes cross, which
+        # needs two different sizes (and a crossing)
+        self.M_intersection = None
+        if len(self.sizes) >= 2:
+            small, large = self.sizes[0], self.sizes[-1]
+            Tc, Mc, _ = find_intersection(self.results[small]["T"], 
+                                          small**(self.beta_nu)*self.results[small]["M"], 
+                                          large**(self.beta_nu)*self.results[large]["M"])
+            if Tc.size > 0: self.M_intersection = (Tc, Mc, Mc)
+
+    def _clear_axes(self):
+        self.ax.clear()
+        return self.fig, self.ax
+
     def _read_results(self, sizes_to_plot):
         sizes = []
         results = {}
 
-        for L in sizes_to_plot:
-            try: 
-                with open(data_path + f'ising_2d_L_{L}.npy', 'rb') as f:
-                    results[L] = np.load(f)
-                    results[L]["E"] /= L**2    # So we can measure E per spin
-
-                sizes.append(L)
+        existing = set(glob(data_path + "ising_2d_L_*.npy"))
 
-            except FileNotFoundError:
+        for L in sizes_to_plot:
+            file_name = data_path + f"ising_2d_L_{L}.npy"
+            if file_name not in existing:
                 print(f"No results available for L = {L}, skipping...")
                 continue
 
+            # Split the structured array (fields interleaved per row) into one contiguous
+            # array per field, since every plot only reads one or two of them at a time.
+            # float32 is plenty for plotting, and halves the memory the scans go through
+            data = np.load(file_name, mmap_mode="r")
+            results[L] = {name: data[name].astype(np.float32) for name in data.dtype.names}
+            results[L]["E"] /= L**2    # So we can measure E per spin
+
+            sizes.append(L)
 
         return sizes, results 
 
@@ -84,7 +140,7 @@ class Plotter:
     def plot_results(self):
         for variable, label in zip(self.variables, self.labels):
 
-            fig, ax = plt.subplots()
+            fig, ax = self._clear_axes()
 
             for i, L in enumerate(self.sizes):
                 T = self.results[L]["T"]
@@ -92,28 +148,23 @@ class Plotter:
 
                 ax.plot(T, X, linestyle="--", color=self.colors[i], label=f"L = {L}")
                 if variable in ["C", "Chi"]:
-                    Tc, Xc = critical_values(T, X)
+                    Tc, Xc = self.peaks[variable][L]
                     ax.text(0.1, 0.8 - i*0.1, f"{label}$_c$ = {round(Xc,3)}, $T_c$ = {round(Tc,3)}", color=self.colors[i], transform=ax.transAxes)
              
             ax.set(xlabel="Temperature [J]", ylabel=label)
             ax.grid()
             ax.legend()
-            plt.tight_layout()
-            for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_{variable}.{ext}")
-
-            plt.cla()
-            plt.clf()
-            plt.close() 
+            save(fig, f"ising_2d_{variable}")
 
     # Answers Q4
     def plot_critical_temperature_chi(self):
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
         critical_temperatures = []
         inv_L = []
 
         for i, L in enumerate(self.sizes):
-            Tc, _ = critical_values(self.results[L]["T"], self.results[L]["Chi"])
+            Tc, _ = self.peaks["Chi"][L]
             critical_temperatures.append(Tc); inv_L.append(1/L)
             ax.scatter(1/L, Tc, color=self.colors[i], s=self.marker_size, marker=self.markers[i], label=f"L = {L}")
 
@@ -127,28 +178,19 @@ class Plotter:
         ax.set(xlabel=r"$L^{-1}$", ylabel=r"$T_{c}(L)$", ylim=(2.3, 2.45))
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_critical_temperature_chi.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_critical_temperature_chi")
 
     # Answers Q5
     def plot_gamma_nu(self):
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
-        log_Xc = []
-        log_L = []
+        log_L = np.log(self.sizes)
         
         for i, L in enumerate(self.sizes):
-            _, Xc = critical_values(self.results[L]["T"], self.results[L]["Chi"])
-            log_Xc.append(np.log(Xc)); log_L.append(np.log(L))
+            _, Xc = self.peaks["Chi"][L]
             ax.scatter(np.log(L), np.log(Xc), color=self.colors[i], s=self.marker_size, marker=self.markers[i], label=f"L = {L}") 
 
-        log_Xc, log_L = np.array(log_Xc), np.array(log_L)
-
-        m, b, _, _, fit_func = fit_line(log_L, log_Xc)
+        m, b, _, _, fit_func = self.gamma_nu_fit
         ax.plot(log_L, fit_func, color="orange", ls="--", label="Fit")
         ax.text(0.6, 0.3, r"$\ln(\chi_c) = \frac{\gamma}{\nu}\ln(L) + f(0)$", transform=ax.transAxes)
         ax.text(0.6, 0.2, r"$\frac{\gamma}{\nu}$" + f" = {round(m,3)}, $f(0)$ = {round(b,3)}", transform=ax.transAxes)
@@ -156,51 +198,37 @@ class Plotter:
         ax.set(xlabel=r"$\ln(L)$", ylabel=r"$\ln(\chi_c)$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_gamma_nu.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_gamma_nu")
 
     #Answers Q5
     def plot_chi_vs_scaling(self):
 
-        log_Xc = []
-        log_L = []
-        
-        for i, L in enumerate(self.sizes):
-            _, Xc = critical_values(self.results[L]["T"], self.results[L]["Chi"])
-            log_Xc.append(np.log(Xc)); log_L.append(np.log(L))
-
-        log_Xc, log_L = np.array(log_Xc), np.array(log_L)
-        gamma_nu, _, _, _, _ = fit_line(log_L, log_Xc)
+        gamma_nu = self.gamma_nu_fit[0]
 
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
         for i, L in enumerate(self.sizes):
             T = self.results[L]["T"]
             X = self.results[L]["Chi"]
-            Tc, _ = critical_values(self.results[L]["T"], self.results[L]["Chi"])
+            Tc, _ = self.peaks["Chi"][L]
 
             ax.plot(L*(T-Tc), L**(-gamma_nu)*X, linestyle="--", color=self.colors[i], label=f"L = {L}") 
 
         ax.set(xlabel=r"$L^{1/\nu}(T-T_c(L))$", ylabel=r"$L^{-\gamma/\nu}\chi$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_chi_vs_scaling.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_chi_vs_scaling")
 
     # Answers Q6
     def plot_beta_nu(self):
 
-        beta_nu = 0.25
+        if self.M_intersection is None:
+            print("No T_c from the M intersection (needs two sizes that cross), skipping beta/nu plot...")
+            return
 
-        fig, ax = plt.subplots()
+        beta_nu = self.beta_nu
+
+        fig, ax = self._clear_axes()
 
         for i, L in enumerate(self.sizes):
             T = self.results[L]["T"]
@@ -208,30 +236,26 @@ class Plotter:
 
             ax.plot(T, L**(beta_nu)*M, linestyle="--", color=self.colors[i], label=f"L = {L}") 
         
-        Tc, Mc, _ = find_intersection(T, self.sizes[0]**(beta_nu)*self.results[self.sizes[0]]["M"], 
-                                        self.sizes[-1]**(beta_nu)*self.results[self.sizes[-1]]["M"])
+        Tc, Mc, _ = self.M_intersection
         
-        ax.plot(Tc, Mc, color="orange", marker="*", markersize=12, linewidth=0, label = f"$T_c$ = {round(Tc[0], 3)}")
+        ax.plot(Tc, Mc, color="orange", marker="*", markersize=12, linewidth=0, label = f"$T_c$ = {round(float(Tc[0]), 3)}")
 
         ax.set(xlabel="Temperature [J]", ylabel=r"$L^{\beta/\nu}M$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_beta_nu.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_beta_nu")
 
     # Answers Q6
     def plot_M_vs_scaling(self):
 
-        beta_nu = 0.25
-        Tc, _, _ = find_intersection(self.results[self.sizes[0]]["T"], 
-                                     self.sizes[0]**(beta_nu)*self.results[self.sizes[0]]["M"], 
-                                     self.sizes[-1]**(beta_nu)*self.results[self.sizes[-1]]["M"])
+        if self.M_intersection is None:
+            print("No T_c from the M intersection (needs two sizes that cross), skipping M scaling plot...")
+            return
+
+        beta_nu = self.beta_nu
+        Tc, _, _ = self.M_intersection
         
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
         for i, L in enumerate(self.sizes):
             T = self.results[L]["T"]
@@ -241,22 +265,17 @@ class Plotter:
         ax.set(xlabel=r"$L^{1/\nu}(T-T_c(L))$", ylabel=r"$L^{\beta/\nu}M$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_M_vs_scaling.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_M_vs_scaling")
 
     # Answers Q7
     def plot_critical_temperature_C(self):
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
         critical_temperatures = []
         inv_L = []
 
         for i, L in enumerate(self.sizes):
-            Tc, _ = critical_values(self.results[L]["T"], self.results[L]["C"])
+            Tc, _ = self.peaks["C"][L]
             critical_temperatures.append(Tc); inv_L.append(1/L)
             ax.scatter(1/L, Tc, color=self.colors[i], s=self.marker_size, marker=self.markers[i], label=f"L = {L}")
 
@@ -270,22 +289,17 @@ class Plotter:
         ax.set(xlabel=r"$L^{-1}$", ylabel=r"$T_{c}'(L)$", ylim=(2.25, 2.4))
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_critical_temperature_C.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close()
+        save(fig, "ising_2d_critical_temperature_C")
 
     # Answers Q7
     def plot_C_divergence(self):
-        fig, ax = plt.subplots()
+        fig, ax = self._clear_axes()
 
         critical_C = []
         log_L = []
 
         for i, L in enumerate(self.sizes):
-            _, Cc = critical_values(self.results[L]["T"], self.results[L]["C"])
+            _, Cc = self.peaks["C"][L]
             critical_C.append(Cc); log_L.append(np.log(L))
             ax.scatter(np.log(L), Cc, color=self.colors[i], s=self.marker_size, marker=self.markers[i], label=f"L = {L}")
 
@@ -294,55 +308,36 @@ class Plotter:
         ax.set(xlabel=r"$\ln(L)$", ylabel=r"$C_c(L)$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_C_divergence.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close() 
+        save(fig, "ising_2d_C_divergence")
 
     # Answers Q8
     def plot_entropy(self):
-        fig, ax = plt.subplots() 
+        fig, ax = self._clear_axes() 
 
         for i, L in enumerate(self.sizes):
             T = self.results[L]["T"]
-            C = self.results[L]["C"]
-            S = numerical_integrate(np.diff(T)[0], C/T)
-            ax.plot(T, S, linestyle="--", color=self.colors[i], label=f"L = {L}")
+            ax.plot(T, self.S[L], linestyle="--", color=self.colors[i], label=f"L = {L}")
 
         ax.axhline(y = np.log(2), color="orange", ls="--", label=r"$\ln(2)$")
 
         ax.set(xlabel="Temperature [J]", ylabel=r"$S(T)$", xlim=(T.min(), T.max()))
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_entropy.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close() 
+        save(fig, "ising_2d_entropy")
 
     # Answers Q8
     def plot_free_energy(self):
-        fig, ax = plt.subplots() 
+        fig, ax = self._clear_axes() 
 
         for i, L in enumerate(self.sizes):
             T = self.results[L]["T"]
-            C = self.results[L]["C"]
             E = self.results[L]["E"]
-            S = numerical_integrate(np.diff(T)[0], C/T)
-            ax.plot(T, E-T*S, linestyle="--", color=self.colors[i], label=f"L = {L}")
+            ax.plot(T, E-T*self.S[L], linestyle="--", color=self.colors[i], label=f"L = {L}")
 
         ax.set(xlabel="Temperature [J]", ylabel=r"$F = E-TS$")
         ax.grid()
         ax.legend()
-        plt.tight_layout()
-        for ext in ["png", "pdf"]: fig.savefig(plots_path + f"ising_2d_free_energy.{ext}")
-
-        plt.cla()
-        plt.clf()
-        plt.close() 
+        save(fig, "ising_2d_free_energy")
 
 def main():
     plotter = Plotter(sizes_to_plot)
@@ -356,6 +351,7 @@ def main():
     plotter.plot_C_divergence()
     plotter.plot_entropy()
     plotter.plot_free_energy()
+    plt.close(plotter.fig)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import math
+from numba import cuda
+from numba.cuda.random import create_xoroshiro128p_states, xoroshiro128p_uniform_float64
+
+#-----------------------------------------------------------------------------
+# GPU version of the checkerboard Metropolis sweep in helper.py. This module is
+# only imported by IsingModel when option = "cuda", so the CPU code never needs
+# a GPU (or the CUDA toolkit) to run.
+
+# See the numba documentation:
+# https://numba.readthedocs.io/en/stable/cuda/index.html
+#-----------------------------------------------------------------------------
+
+threads_per_block = (16, 16)
+
+@cuda.jit
+def mc_kernel_color(state, rng_states, L, prob_table, color):
+    """
+    Metropolis update of every site (i, j) with (i+j)%2 == color, one thread per site.
+    Same acceptance rule and Boltzmann table as helper.mc_step_metropolis(), and every
+    site has its own xoroshiro128+ random number stream. The uniforms are doubles like
+    on the CPU: a float32 draw is exactly 0 once in 2^24, which would accept moves whose
+    Boltzmann factor is ~1e-116 at the lowest temperatures.
+    """
+    i, j = cuda.grid(2)
+    if i >= L or j >= L or (i+j)%2 != color: return
+
+    s = state[i, j]
+    nn_sum = state[(i+1)%L, j] + state[i, (j+1)%L] + state[(i-1)%L, j] + state[i, (j-1)%L]
+
+    cost = s*nn_sum     # Flip costs 2*J*cost, only the sign matters here
+
+    if cost <= 0: state[i, j] = -s
+    elif xoroshiro128p_uniform_float64(rng_states, i*L + j) < prob_table[(cost+4)//2]: state[i, j] = -s
+
+def mc_step(d_state, rng_states, L, d_prob_table):
+    """
+    Does a Monte Carlo (MC) step on the GPU, launching one kernel per color. The state
+    stays on the device, nothing is copied back.
+
+    Parameters
+    ----------
+    d_state : DeviceNDArray
+        Current ising spin state (int8) on the device.
+
+    rng_states : DeviceNDArray
+        One random number state per site, see init_rng().
+
+    L : int
+        System size being simulated. Must be even.
+
+    d_prob_table : DeviceNDArray
+        Boltzmann factors for the current temperature, see helper._build_prob_table().
+
+    """
+    blocks = (math.ceil(L/threads_per_block[0]), math.ceil(L/threads_per_block[1]))
+
+    for color in (0, 1):
+        mc_kernel_color[blocks, threads_per_block](d_state, rng_states, L, d_prob_table, color)
+
+def init_rng(L, seed):
+    """
+    Returns L*L independent xoroshiro128+ states on the device, one per site.
+    """
+    return create_xoroshiro128p_states(L*L, seed=seed)
@@ -1,5 +1,5 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 import time
 
 def timer(function):
@@ -24,29 +24,102 @@ def timer(function):
 # Some njit functions, these are compiled during runtime to make the 
 # calculations v. fast; below the loops work at essentially C speed.
 
+# The signatures are given explicitly, so everything is compiled once when the
+# module is imported and cached to __pycache__, instead of at the first call.
+# The kernels also release the GIL (nogil), so they can run concurrently from
+# several Python threads on separate lattices.
+
 # See the numba documentation: 
 # https://numba.readthedocs.io/en/stable/user/5minguide.html
 #-----------------------------------------------------------------------------
 
-@njit
+@njit('int32[:, ::1](int64)', cache=True)
+def _neighbor_table(L):
+    """
+    Periodic nearest neighbors of every site, using the flat index k = i*L + j of the
+    (C-ordered) lattice. Row k holds the flat indices of the up, down, left, and right 
+    neighbors, so the sweeps do a single lookup instead of 2D index math and an
+    integer modulo for every spin.
+    """
+    nbrs = np.empty((L*L, 4), dtype=np.int32)
+    for i in range(L):
+        for j in range(L):
+            k = i*L + j
+            nbrs[k, 0] = ((i-1)%L)*L + j
+            nbrs[k, 1] = ((i+1)%L)*L + j
+            nbrs[k, 2] = i*L + (j-1)%L
+            nbrs[k, 3] = i*L + (j+1)%L
+
+    return nbrs
+
+@njit('uint64(uint64, int64)', cache=True)
+def _rotl(x, k):
+    return (x << np.uint64(k)) | (x >> np.uint64(64 - k))
+
+@njit('uint64(uint64[::1])', cache=True, nogil=True)
+def _xoshiro_next(s):
+    """
+    Advances a xoshiro256** generator (4 x uint64 state, updated in place) and returns 
+    the next 64 random bits. This is a handful of shifts and xors that numba can inline, 
+    much cheaper than going through np.random for every spin.
+    See: https://prng.di.unimi.it/xoshiro256starstar.c
+    """
+    result = _rotl(s[1]*np.uint64(5), 7)*np.uint64(9)
+    t = s[1] << np.uint64(17)
+
+    s[2] ^= s[0]
+    s[3] ^= s[1]
+    s[1] ^= s[2]
+    s[0] ^= s[3]
+    s[2] ^= t
+    s[3] = _rotl(s[3], 45)
+
+    return result
+
+@njit('float64(uint64[::1])', cache=True, nogil=True)
+def _uniform(s):
+    """
+    Uniform double in [0, 1) from the top 53 bits of the xoshiro256** output.
+
+    The sweeps draw these one at a time, and only for the moves that can actually be
+    rejected (cost > 0). Drawing a whole sweep's worth up front would mean a buffer of
+    L*L numbers, most of them never used, and going through memory twice for them.
+    """
+    return (_xoshiro_next(s) >> np.uint64(11))*(1.0/9007199254740992.0)
+
+def _seed_rng(n_streams, seed=None):
+    """
+    Returns n_streams independent xoshiro256** states, shape (n_streams, 4), seeded 
+    through np.random.SeedSequence so the same seed always gives the same run.
+    """
+    return np.random.SeedSequence(seed).generate_state(4*n_streams, dtype=np.uint64).reshape(n_streams, 4)
+
+@njit('float64(int8[:, ::1], int64, float64)', cache=True, fastmath=True, nogil=True)
 def energy(state, L, J):
     """
     Calculates energy from H = -J * Sum_{nn} S_i S_j. 
         
-    This goes through every spin (double starred) and sums its nearest neighbors (starred),
-    then the contribution to the energy is the (**) spin times the nearest neighbor sum.
+    This goes through every spin (double starred) and sums its down and right nearest 
+    neighbors (starred), then the contribution to the energy is the (**) spin times 
+    that sum.
 
-    [[ 1,    1*,  -1,  -1]
-     [-1*,  1**,   1*, -1]
+    [[ 1,    1,   -1,  -1]
+     [-1,   1**,   1*, -1]
      [ 1,   -1*,  -1,   1]
      [ 1,    1,   -1,  -1]]
 
-    Doing this overcounts the nearest neighbor sum by 4, so we divide by 1/4. 
+    The up and left links are the down and right links of other spins, so every link
+    is counted exactly once, with half the neighbor loads of a full 4 neighbor sum.
+
+    The neighbors are read straight from the rows (no neighbor table), and only the
+    wrap around is handled separately: the row below the last one is row 0, and the 
+    last column is peeled off the inner loop. The inner loop is then a plain 
+    contiguous loop that LLVM can vectorize.
 
     Parameters
     ----------
     state : np.ndarray
-        Current ising spin state.
+        Current ising spin state, stored as int8.
 
     L : int
         System size being simulated.
@@ -60,33 +133,208 @@ def energy(state, L, J):
         The energy measurement for the given spin configuration.
 
     """
-    energy = 0
+    energy = np.int64(0)    # The spins are int8, accumulate in int64 so large L cannot overflow
 
     for i in range(L):
-        for j in range(L):
-            s = state[i,j]
-            nn_sum = state[(i+1)%L, j] + state[i,(j+1)%L] + state[(i-1)%L, j] + state[i,(j-1)%L]
-            energy += s *nn_sum
+        row = state[i]
+        down = state[i+1] if i < L-1 else state[0]
+
+        for j in range(L-1):
+            energy += np.int32(row[j])*(np.int32(down[j]) + row[j+1])
+
+        energy += np.int32(row[L-1])*(np.int32(down[L-1]) + row[0])
+
+    return -J*energy
+
+@njit('float64(int8[:, ::1])', cache=True, fastmath=True, nogil=True)
+def magnetization(state):
+    """
+    Calculates M = <S_i> = |Sum_{i} S_i| / N.
+
+    Parameters
+    ----------
+    state : np.ndarray
+        Current ising spin state, stored as int8.
+
+    Returns
+    -------
+    float
+        The magnetization per spin for the given spin configuration.
+
+    """
+    total = np.int64(0)     # The spins are int8, accumulate in int64 so large L cannot overflow
+
+    for i in range(state.shape[0]):
+        for j in range(state.shape[1]):
+            total += state[i, j]
+
+    return abs(total)/state.size
+
+@njit('UniTuple(float64, 2)(int8[:, ::1], int64, float64)', cache=True, fastmath=True, nogil=True)
+def observables(state, L, J):
+    """
+    Calculates both the energy and the magnetization in a single pass over the lattice,
+    see energy() and magnetization(). The loop is peeled at the boundary the same way
+    as in energy().
+
+    Parameters
+    ----------
+    state : np.ndarray
+        Current ising spin state, stored as int8.
+
+    L : int
+        System size being simulated.
+
+    J : float
+        Nearest neighbors interaction strength coefficient.
 
-    # We overcount the links by 2
-    return -J*(energy/2)
+    Returns
+    -------
+    tuple(float)
+        The energy and the magnetization per spin for the given spin configuration.
 
-@njit
-def mc_step_metropolis(state, L, T, J, N):
+    """
+    energy = np.int64(0)    # The spins are int8, accumulate in int64 so large L cannot overflow
+    total = np.int64(0)
+
+    for i in range(L):
+        row = state[i]
+        down = state[i+1] if i < L-1 else state[0]
+
+        for j in range(L-1):
+            s = np.int32(row[j])
+            energy += s*(np.int32(down[j]) + row[j+1])
+            total += s
+
+        s = np.int32(row[L-1])
+        energy += s*(np.int32(down[L-1]) + row[0])
+        total += s
+
+    return -J*energy, abs(total)/(L*L)
+
+@njit('float64[::1](float64, float64)', cache=True)
+def _build_prob_table(T, J):
+    """
+    Acceptance probabilities min(1, exp(-2*J*s*Sum_{nn}/T)) for the only values 
+    s*Sum_{nn} can take in 2D, i.e. -4, -2, 0, 2, 4. These are indexed by 
+    (s*Sum_{nn} + 4)//2. Moves that lower (or keep) the energy get probability 1, so
+    the entries are true probabilities and never overflow at very low T.
+    """
+    prob_table = np.empty(5)
+    for k in range(5):
+        prob_table[k] = min(1.0, np.exp(-2*J*(2*k-4)/T))
+
+    return prob_table
+
+@njit(inline='always')
+def _metropolis_site(flat, k, prob_table, nbrs, rng):
+    """
+    Metropolis update of the single site with flat index k, see mc_step_metropolis().
+    """
+    s = np.int32(flat[k])
+    nn_sum = np.int32(flat[nbrs[k, 0]]) + flat[nbrs[k, 1]] + flat[nbrs[k, 2]] + flat[nbrs[k, 3]]
+
+    cost = s*nn_sum     # Flip costs 2*J*cost
+
+    # The table alone would do (it's 1 for cost <= 0), but skipping the random number
+    # for the always accepted moves is faster
+    if cost <= 0: flat[k] = -s
+    elif _uniform(rng) < prob_table[(cost+4)//2]: flat[k] = -s
+
+@njit(inline='always')
+def _metropolis_sweep(flat, L, prob_table, nbrs, rng):
+    """
+    Serial version of the checkerboard sweep in mc_step_metropolis(), for a single
+    lattice handled by a single thread.
+    """
+    L_even = L - (L & 1)
+
+    for color in (0, 1):
+        for i in range(L_even):
+            for j in range((i+color)&1, L_even, 2):
+                _metropolis_site(flat, i*L + j, prob_table, nbrs, rng[i])
+
+    if L_even < L:
+        for i in range(L_even):
+            _metropolis_site(flat, i*L + L-1, prob_table, nbrs, rng[i])
+
+        for j in range(L):
+            _metropolis_site(flat, (L-1)*L + j, prob_table, nbrs, rng[L-1])
+
+@njit('void(int8[:, ::1], int64, float64[::1], int32[:, ::1], uint64[:, ::1])', parallel=True, fastmath=True, cache=True, nogil=True)
+def mc_step_metropolis(state, L, prob_table, nbrs, rng):
     """
     Does a Monte Carlo (MC) step using the Metropolis algorithm. 
     
-    Loop through the number of spin sites of the system. For every iterations, 
-    pick a random test spin site to flip. The energy cost of flipping a single 
-    spin at location i, j is 2*J*s_{i,j}*Sum_{nn}, and if this energy cost is < 0, 
-    we accept the spin flip. Otherwise, if the ratio of the P_new/P_old probabilities 
-    is >= r (where r is a random number between 0 and 1), we keep the change. Else, 
-    the spin flip is rejected. 
+    The lattice is swept as a checkerboard: first every "even" site (i+j even) is
+    visited, then every "odd" one. Nearest neighbors always have opposite colors, so
+    all the sites of one color can be updated at the same time, and each row is handed
+    to a different thread with prange. Each row also has its own random number stream,
+    so the result doesn't depend on how rows are split among threads. The energy cost 
+    of flipping a single spin at location i, j is 2*J*s_{i,j}*Sum_{nn}, and if the 
+    ratio of the P_new/P_old probabilities (capped at 1, so any move with energy cost 
+    <= 0 passes) is > r, where r is a random number between 0 and 1, we keep the 
+    change. Else, the spin flip is rejected. 
+
+    With periodic boundaries and an odd L, the last row and column have neighbors of 
+    the same color across the boundary. In that case the checkerboard only covers the
+    first L-1 rows and columns, and the last row and column are updated one site at a
+    time afterwards.
+
+    Parameters
+    ----------
+    state : np.ndarray
+        Current ising spin state, stored as int8.
+
+    L : int
+        System size being simulated.
+
+    prob_table : np.ndarray
+        Boltzmann factors for the current temperature, see _build_prob_table().
+
+    nbrs : np.ndarray
+        Flat indices of the nearest neighbors of every site, see _neighbor_table().
+
+    rng : np.ndarray
+        One xoshiro256** state per row, shape (L, 4), see _seed_rng().
+
+    Returns
+    -------
+    None
+        The state is updated in place with the accepted changes.
+        
+    """
+    flat = state.reshape(L*L)   # View, the flips still land in state
+    L_even = L - (L & 1)        # Size of the part that can be colored consistently
+
+    for color in (0, 1):
+        for i in prange(L_even):
+            for j in range((i+color)&1, L_even, 2):
+                _metropolis_site(flat, i*L + j, prob_table, nbrs, rng[i])
+
+    if L_even < L:
+        for i in range(L_even):
+            _metropolis_site(flat, i*L + L-1, prob_table, nbrs, rng[i])
+
+        for j in range(L):
+            _metropolis_site(flat, (L-1)*L + j, prob_table, nbrs, rng[L-1])
+
+@njit('int64(int8[:, ::1], int64, float64, float64, int32[:, ::1], uint64[:, ::1])', cache=True, nogil=True)
+def mc_step_wolff(state, L, T, J, nbrs, rng):
+    """
+    Does a Monte Carlo (MC) step using the Wolff cluster algorithm.
+
+    Starting from a random seed spin, grow a cluster by adding each aligned nearest
+    neighbor with probability p_add = 1 - exp(-2*J/T), then flip the whole cluster.
+    Spins are flipped as soon as they join the cluster, so a site can never be added
+    twice and the stack of (flat) frontier sites never needs more than L*L entries. 
+    Near T_c this beats single spin flips by a lot, since the autocorrelation time 
+    barely grows with L.
 
     Parameters
     ----------
     state : np.ndarray
-        Current ising spin state.
+        Current ising spin state, stored as int8.
 
     L : int
         System size being simulated.
@@ -97,23 +345,277 @@ def mc_step_metropolis(state, L, T, J, N):
     J : float
         Nearest neighbors interaction strength coefficient.
 
-    N : int
-        Total number of spins in the system.
+    nbrs : np.ndarray
+        Flat indices of the nearest neighbors of every site, see _neighbor_table().
+
+    rng : np.ndarray
+        xoshiro256** states, see _seed_rng(). Only the first stream is used.
+
+    Returns
+    -------
+    int
+        Number of spins in the flipped cluster. The state is updated in place.
+
+    """
+    p_add = 1 - np.exp(-2*J/T)
+    flat = state.reshape(L*L)
+    stack = np.empty(L*L, dtype=np.int32)
+    s0 = rng[0]
+
+    seed = (_xoshiro_next(s0) >> np.uint64(32)) % np.uint64(L*L)
+    s = flat[seed]
+
+    flat[seed] = -s
+    stack[0] = seed
+    n_stack, cluster_size = 1, 1
+
+    while n_stack > 0:
+        n_stack -= 1
+        k = stack[n_stack]
+
+        for n in range(4):
+            x = nbrs[k, n]
+            if flat[x] == s and _uniform(s0) < p_add:
+                flat[x] = -s
+                stack[n_stack] = x
+                n_stack += 1
+                cluster_size += 1
+
+    return cluster_size
+
+@njit('uint64[::1](int8[:, ::1], int64)', cache=True, nogil=True)
+def pack_spins(state, L):
+    """
+    Packs every row of the lattice into one uint64, with bit j set if spin (i, j) is up.
+    Used by the multi-spin coded sweep, so only works for L <= 64.
+    """
+    words = np.zeros(L, dtype=np.uint64)
+    for i in range(L):
+        for j in range(L):
+            if state[i, j] > 0: words[i] |= np.uint64(1) << np.uint64(j)
+
+    return words
+
+@njit('void(uint64[::1], int8[:, ::1], int64)', cache=True, nogil=True)
+def unpack_spins(words, state, L):
+    """
+    Inverse of pack_spins(), writes the packed rows back into the int8 lattice.
+    """
+    for i in range(L):
+        w = words[i]
+        for j in range(L):
+            state[i, j] = 2*np.int8((w >> np.uint64(j)) & np.uint64(1)) - 1
+
+@njit('void(uint64[::1], int64, float64[::1], uint64[:, ::1], uint64[::1])', parallel=True, fastmath=True, cache=True, nogil=True)
+def mc_step_multispin(words, L, prob_table, rng, flips):
+    """
+    Does a Monte Carlo (MC) step using the Metropolis algorithm, with multi-spin coding.
+
+    Each row of the lattice is packed into a single uint64 (see pack_spins()), so the
+    neighbors of a whole row are just the rows above and below, and the row itself 
+    rotated by one bit. XOR with the spin gives a bit for every anti-aligned neighbor,
+    and a couple of bitwise adders count them for all the sites of the row at once.
+
+    With c anti-aligned neighbors, s*Sum_{nn} = 4 - 2c, so c >= 2 flips are always 
+    accepted. Only the c = 1 and c = 0 sites need a random number, compared against 
+    the same Boltzmann factors as mc_step_metropolis(). The sweep is done as a
+    checkerboard like mc_step_metropolis(): the flips of one color are computed for 
+    all rows in parallel (reading only), then applied.
+
+    NOTE: needs an even L <= 64.
+
+    Parameters
+    ----------
+    words : np.ndarray
+        Current ising spin state, packed with pack_spins().
+
+    L : int
+        System size being simulated.
+
+    prob_table : np.ndarray
+        Boltzmann factors for the current temperature, see _build_prob_table().
+
+    rng : np.ndarray
+        One xoshiro256** state per row, shape (L, 4), see _seed_rng().
+
+    flips : np.ndarray
+        Scratch space of length L for the flip masks.
+
+    Returns
+    -------
+    None
+        The packed state is updated in place with the accepted changes.
+
+    """
+    one = np.uint64(1)
+    row_mask = np.uint64(0xFFFFFFFFFFFFFFFF) >> np.uint64(64 - L)
+    even_bits = np.uint64(0x5555555555555555) & row_mask
+
+    for color in (0, 1):
+        for i in prange(L):
+            w = words[i]
+
+            # Anti-aligned neighbor bits: up, down, left (spin j-1), right (spin j+1)
+            a1 = w ^ words[(i-1)%L]
+            a2 = w ^ words[(i+1)%L]
+            a3 = w ^ (((w << one) | (w >> np.uint64(L-1))) & row_mask)
+            a4 = w ^ ((w >> one) | ((w & one) << np.uint64(L-1)))
+
+            # Count them: c = ones + 2*(c1 + c2 + carry)
+            s1, c1 = a1 ^ a2, a1 & a2
+            s2, c2 = a3 ^ a4, a3 & a4
+            ones, carry = s1 ^ s2, s1 & s2
+            at_least_2 = c1 | c2 | carry
+
+            sublattice = even_bits if (i+color)&1 == 0 else even_bits ^ row_mask
+
+            flip = at_least_2 & sublattice
+            exactly_1 = ones & ~at_least_2 & sublattice
+            exactly_0 = ~(ones | at_least_2) & sublattice
+
+            # s*Sum_{nn} = 2 and 4, i.e. prob_table[3] and prob_table[4]
+            while exactly_1:
+                bit = exactly_1 & (~exactly_1 + one)
+                if _uniform(rng[i]) < prob_table[3]: flip |= bit
+                exactly_1 ^= bit
+
+            while exactly_0:
+                bit = exactly_0 & (~exactly_0 + one)
+                if _uniform(rng[i]) < prob_table[4]: flip |= bit
+                exactly_0 ^= bit
+
+            flips[i] = flip
+
+        for i in prange(L):
+            words[i] ^= flips[i]
+
+@njit('void(int8[:, :, ::1], int64, float64[:, ::1], int32[:, ::1], uint64[:, :, ::1])', parallel=True, fastmath=True, cache=True, nogil=True)
+def mc_step_metropolis_batched(states, L, prob_tables, nbrs, rng):
+    """
+    Does a Monte Carlo (MC) step using the Metropolis algorithm on a whole batch of
+    independent lattices of the same size, one per temperature.
+
+    Every replica is swept exactly like in mc_step_metropolis() (same checkerboard 
+    order, same random number streams), but the replicas are handed to the threads 
+    instead of the rows, so each thread works on its own contiguous LxL block and a 
+    single call advances every temperature.
+
+    Parameters
+    ----------
+    states : np.ndarray
+        Current ising spin states, stored as int8, shape (nT, L, L).
+
+    L : int
+        System size being simulated.
+
+    prob_tables : np.ndarray
+        Boltzmann factors for every temperature, shape (nT, 5), see _build_prob_table().
+
+    nbrs : np.ndarray
+        Flat indices of the nearest neighbors of every site, see _neighbor_table().
+
+    rng : np.ndarray
+        One xoshiro256** state per row of every replica, shape (nT, L, 4).
+
+    Returns
+    -------
+    None
+        The states are updated in place with the accepted changes.
+
+    """
+    for t in prange(states.shape[0]):
+        _metropolis_sweep(states[t].reshape(L*L), L, prob_tables[t], nbrs, rng[t])
+
+@njit('Tuple((float64[::1], float64[::1]))(int8[:, :, ::1], int64, float64)', parallel=True, cache=True, nogil=True)
+def observables_batched(states, L, J):
+    """
+    Energy and magnetization per spin of every replica in a batch, see observables().
+    """
+    n = states.shape[0]
+    E, M = np.empty(n), np.empty(n)
+
+    for t in prange(n):
+        E[t], M[t] = observables(states[t], L, J)
+
+    return E, M
+
+@njit(inline='always')
+def _accumulate(stats, n, E, M):
+    """
+    Adds the n-th (1-based) measurement to stats = [<E>, n*Var(E), <M>, n*Var(M)], 
+    with Welford's update. Unlike Sum E^2/n - (Sum E/n)^2, this doesn't lose the 
+    variance to cancellation when it is tiny compared to E^2 (e.g. at low T).
+    """
+    d = E - stats[0]
+    stats[0] += d/n
+    stats[1] += d*(E - stats[0])
+
+    d = M - stats[2]
+    stats[2] += d/n
+    stats[3] += d*(M - stats[2])
+
+@njit('float64[:, ::1](int8[:, :, ::1], int64, float64, float64[:, ::1], int32[:, ::1], uint64[:, :, ::1], int64, int64, int64)', parallel=True, cache=True, nogil=True)
+def run_sweeps_batched(states, L, J, prob_tables, nbrs, rng, thermalize_sweeps, msmt_sweeps, msmt_rate):
+    """
+    Runs the whole Metropolis simulation of a batch of replicas (see 
+    mc_step_metropolis_batched()): thermalize_sweeps sweeps, then msmt_sweeps more with
+    a measurement every msmt_rate of them. The loop over sweeps stays in compiled code, 
+    so there is no Python call per sweep, and each thread takes a replica through the
+    whole simulation, so the threads never have to wait for each other between sweeps.
+    A single lattice is just a batch of one, e.g. state[None].
+
+    Parameters
+    ----------
+    states : np.ndarray
+        Current ising spin states, stored as int8, shape (nT, L, L).
+
+    L : int
+        System size being simulated.
+
+    J : float
+        Nearest neighbors interaction strength coefficient.
+
+    prob_tables : np.ndarray
+        Boltzmann factors for every temperature, shape (nT, 5), see _build_prob_table().
+
+    nbrs : np.ndarray
+        Flat indices of the nearest neighbors of every site, see _neighbor_table().
+
+    rng : np.ndarray
+        One xoshiro256** state per row of every replica, shape (nT, L, 4).
+
+    thermalize_sweeps, msmt_sweeps, msmt_rate : int
+        See simulate.simulate().
 
     Returns
     -------
     np.ndarray
-        A new ising state with the accepted changes.
-        
+        Shape (nT, 4), the mean and variance of the energy, then the mean and variance
+        of the magnetization, of every replica. The states are updated in place.
+
     """
-    for _ in range(N):
-        a = np.random.randint(0, L)
-        b = np.random.randint(0, L)
+    n = states.shape[0]
+    stats = np.zeros((n, 4))
+
+    for t in prange(n):
+        flat = states[t].reshape(L*L)
+
+        for i in range(thermalize_sweeps):
+            _metropolis_sweep(flat, L, prob_tables[t], nbrs, rng[t])
+
+        n_msmts = 0
+
+        for i in range(msmt_sweeps):
+            _metropolis_sweep(flat, L, prob_tables[t], nbrs, rng[t])
 
-        s = state[a, b]
-        nn_sum = state[(a+1)%L, b] + state[a,(b+1)%L] + state[(a-1)%L, b] + state[a,(b-1)%L]
+            # A full pass every msmt_rate sweeps is cheaper than keeping E and M up to
+            # date from every accepted flip, which slows down each sweep instead
+            if i % msmt_rate == 0:
+                msmt_energy, msmt_magnetization = observables(states[t], L, J)
+                n_msmts += 1
+                _accumulate(stats[t], n_msmts, msmt_energy, msmt_magnetization)
 
-        cost = 2*J*s*nn_sum
+        stats[t, 1] /= n_msmts
+        stats[t, 3] /= n_msmts
 
-        if cost < 0: state[a, b] = -s
-        elif np.random.rand() <= np.exp(-cost*(1/T)): state[a, b] = -s
+    return stats
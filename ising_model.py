@@ -3,11 +3,11 @@ import helper
 
 class IsingModel:
 
-    def __init__(self, L, T, J=1):
+    def __init__(self, L, T, J=1, option="metropolis", seed=None):
         """
         Class representing the Ising model for a given lattice size, temperature, and
         interaction term, with an option to update the spin configuration using the
-        Metropolis algorithm
+        Metropolis (plain, multi-spin coded, or on a GPU) or the Wolff cluster algorithm
 
         Parameters
         ----------
@@ -19,22 +19,95 @@ class IsingModel:
 
         J : float
             Nearest neighbor interaction constant.
+
+        option : str
+            Update algorithm, either "metropolis", "multispin" (Metropolis on bit-packed
+            rows, needs L <= 64), "cuda" (Metropolis on an NVIDIA GPU, needs numba's 
+            CUDA support), or "cluster" (Wolff).
+
+        seed : int or None
+            Seed for the initial state and the random number streams of the MC steps.
+            If None, fresh entropy is pulled from the OS.
         
         """
+        if option not in ("metropolis", "multispin", "cuda", "cluster"):
+            raise ValueError(f"Unknown update option '{option}', use 'metropolis', 'multispin', 'cuda' or 'cluster'")
+
+        if option in ("multispin", "cuda") and L % 2 != 0:
+            raise ValueError(f"The {option} checkerboard sweep needs an even L, got L = {L}")
+
+        if option == "multispin" and L > 64:
+            raise ValueError(f"Multi-spin coding packs a row into 64 bits, got L = {L}")
+
         self.L = L      # Lattice size
         self.T = T*J    # Temperature (in units of J)
         self.J = J      # Neighbor interaction strength
+        self.option = option
 
+        self._gen = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])   # For the initial states
         self.state = self._get_initial_state()
+        self._nbrs = helper._neighbor_table(self.L)    # Flat indices of the periodic neighbors
+        self.prob_table = helper._build_prob_table(self.T, self.J)   # Boltzmann factors, fixed for this T
+        self._rng = helper._seed_rng(self.L, seed)     # One random number stream per row
+        self._observables = None    # (E, M) of the current state, measured on demand
+
+        # Performs a Monte Carlo (MC) step with the chosen algorithm. The method is picked
+        # once here, so there is no check of the option on every step
+        self.mc_step = {"metropolis": self._mc_metropolis, "multispin": self._mc_multispin,
+                        "cuda": self._mc_cuda, "cluster": self._mc_cluster}[option]
+
+        if option == "multispin":
+            self._words = helper.pack_spins(self.state, self.L)   # One uint64 per row
+            self._flips = np.empty(self.L, dtype=np.uint64)
+
+        if option == "cuda":
+            import cuda_helper  # Only needed (and importable) with a GPU setup
+            self._cuda = cuda_helper
+            self._d_state = cuda_helper.cuda.to_device(self.state)
+            self._d_prob_table = cuda_helper.cuda.to_device(self.prob_table)
+            self._d_rng = cuda_helper.init_rng(self.L, int(self._rng[0, 0]))
 
     def _get_initial_state(self):
         """
         Returns lattice of size LxL with up spins (+1) and down spins (-1). If the temperature
         is low enough, start with all spins up. This makes the thermalization step more likely
         to converge. Otherwise, start with a random configuration.
+
+        Spins are stored as int8 (1 byte instead of 8), which keeps the lattice small 
+        enough to stay in cache during the sweeps. The random bits are drawn as int8 and
+        mapped 0, 1 -> -1, 1 in place, so there are no temporaries at all.
         """
-        if self.T / self.J < 1 : return np.ones((self.L, self.L))
-        else: return 2*np.random.randint(2, size=(self.L, self.L))-1
+        if self.T / self.J < 1 : return np.ones((self.L, self.L), dtype=np.int8)
+
+        state = self._gen.integers(0, 2, size=(self.L, self.L), dtype=np.int8)
+        state <<= 1
+        state -= 1
+        return state
+
+    def reset(self, T):
+        """
+        Starts over at a new temperature T, reusing the lattice and the rest of the 
+        buffers instead of building a new model. The random number streams carry on 
+        from where they were, so the new run is still independent of the old one.
+        """
+        self.T = T*self.J
+        self.state[...] = self._get_initial_state()
+        self.prob_table[:] = helper._build_prob_table(self.T, self.J)
+        self._observables = None
+
+        if self.option == "multispin":
+            self._words[:] = helper.pack_spins(self.state, self.L)
+
+        if self.option == "cuda":
+            self._d_state.copy_to_device(self.state)
+            self._d_prob_table.copy_to_device(self.prob_table)
+
+    def _sync_state(self):
+        """
+        With option = "cuda" the sweeps only update the lattice on the device, so copy 
+        it back before measuring anything.
+        """
+        if self.option == "cuda": self._d_state.copy_to_host(self.state)
 
     @property
     def total_spins(self):
@@ -46,8 +119,12 @@ class IsingModel:
     @property
     def energy(self):
         """
-        Returns the total energy for the current spin configuration.
+        Returns the total energy for the current spin configuration. Use observables
+        when the magnetization is needed too, to go over the lattice only once.
         """
+        if self._observables is not None: return self._observables[0]
+
+        self._sync_state()
         return helper.energy(self.state, self.L, self.J)
 
     @property
@@ -57,10 +134,123 @@ class IsingModel:
 
         Here 'i' goes through the entire lattice, and N is the total number of spins.
         """
-        return np.abs(np.sum(self.state))/self.total_spins
+        if self._observables is not None: return self._observables[1]
+
+        self._sync_state()
+        return helper.magnetization(self.state)
     
+    @property
+    def observables(self):
+        """
+        Returns the energy and magnetization together, walking the lattice only once.
+        The result is kept until the next MC step, so reading the energy and then the
+        magnetization of the same configuration doesn't go over the lattice twice.
+        """
+        if self._observables is None:
+            self._sync_state()
+            self._observables = helper.observables(self.state, self.L, self.J)
+
+        return self._observables
+
+    def _mc_metropolis(self):
+        """
+        Performs a Monte Carlo (MC) step with the Metropolis algorithm.
+        """
+        self._observables = None    # The configuration is about to change
+        helper.mc_step_metropolis(self.state, self.L, self.prob_table, self._nbrs, self._rng) #NOTE this is pass by reference
+
+    def _mc_multispin(self):
+        """
+        Performs a Monte Carlo (MC) step with the multi-spin coded Metropolis algorithm.
+        """
+        self._observables = None
+        helper.mc_step_multispin(self._words, self.L, self.prob_table, self._rng, self._flips)
+        helper.unpack_spins(self._words, self.state, self.L)  # Keep state in sync for measurements
+
+    def _mc_cuda(self):
+        """
+        Performs a Monte Carlo (MC) step with the Metropolis algorithm on the GPU.
+        """
+        self._observables = None
+        self._cuda.mc_step(self._d_state, self._d_rng, self.L, self._d_prob_table)
+
+    def _mc_cluster(self):
+        """
+        Flips a single Wolff cluster.
+        """
+        self._observables = None
+        helper.mc_step_wolff(self.state, self.L, self.T, self.J, self._nbrs, self._rng)
+
+class BatchedIsingModel:
+
+    def __init__(self, L, temperatures, J=1, seed=None):
+        """
+        A batch of independent Ising models of the same size, one per temperature, all
+        updated with the Metropolis algorithm. The lattices are stacked in a single 
+        (nT, L, L) array, so one call sweeps every temperature at once.
+
+        Parameters
+        ----------
+        L : int
+            System size.
+
+        temperatures : np.ndarray
+            System temperatures, one replica each.
+
+        J : float
+            Nearest neighbor interaction constant.
+
+        seed : int or None
+            Seed for the initial state and the random number streams of the MC steps.
+            If None, fresh entropy is pulled from the OS.
+
+        """
+        self.L = L      # Lattice size
+        self.T = np.asarray(temperatures, dtype=float)*J    # Temperatures (in units of J)
+        self.J = J      # Neighbor interaction strength
+
+        self._gen = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+        self.state = self._get_initial_state()
+        self._nbrs = helper._neighbor_table(self.L)
+        self.prob_table = np.stack([helper._build_prob_table(T, self.J) for T in self.T])  # Shape (nT, 5)
+        self._rng = helper._seed_rng(self.T.size*self.L, seed).reshape(self.T.size, self.L, 4)
+
+    def _get_initial_state(self):
+        """
+        Returns the (nT, L, L) int8 lattices, with the same starting configuration as 
+        IsingModel for each temperature: all up if T/J < 1, random otherwise.
+        """
+        state = self._gen.integers(0, 2, size=(self.T.size, self.L, self.L), dtype=np.int8)
+        state <<= 1
+        state -= 1
+        state[self.T / self.J < 1] = 1
+        return state
+
+    def reset(self, temperatures):
+        """
+        Starts over at new temperatures (as many as before), reusing the lattices and
+        the rest of the buffers, see IsingModel.reset().
+        """
+        self.T[:] = np.asarray(temperatures, dtype=float)*self.J
+        self.state[...] = self._get_initial_state()
+        for t, T in enumerate(self.T): self.prob_table[t] = helper._build_prob_table(T, self.J)
+
+    @property
+    def total_spins(self):
+        """
+        Returns the number of spins N = L*L of each replica.
+        """
+        return (self.L)**2
+
+    @property
+    def observables(self):
+        """
+        Returns the energy and magnetization arrays, one entry per temperature.
+        """
+        return helper.observables_batched(self.state, self.L, self.J)
+
     def mc_step(self):
         """
-        Performs a Monte Carlo (MC) step with the Metropolis algorithm. 
+        Performs a Metropolis Monte Carlo (MC) step on every replica.
         """
-        helper.mc_step_metropolis(self.state, self.L, self.T, self.J, self.total_spins) #NOTE this is pass by reference
\ No newline at end of file
+        helper.mc_step_metropolis_batched(self.state, self.L, self.prob_table, self._nbrs, self._rng)
@@ -1,11 +1,14 @@
 import numpy as np
 from functools import partial
-from multiprocessing import Pool, cpu_count
-from ising_model import IsingModel
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, get_context
+from numba import set_num_threads
+import helper
+from ising_model import IsingModel, BatchedIsingModel
 
 data_path = "./data/"
 
-def simulate(thermalize_sweeps, msmt_sweeps, msmt_rate, L, T, verbose=False):
+def simulate(thermalize_sweeps, msmt_sweeps, msmt_rate, L, T, verbose=False, option="metropolis", ising=None):
     """
     Runs the simulation for the ising model.
 
@@ -30,38 +33,103 @@ def simulate(thermalize_sweeps, msmt_sweeps, msmt_rate, L, T, verbose=False):
     verbose : bool
         If 'True', turns on printouts for steps in sweep.
 
+    option : str
+        Update algorithm passed to IsingModel: "metropolis", "multispin" (even 
+        L <= 64), "cuda" (even L, needs a GPU), or "cluster". With "cluster" every 
+        sweep flips a single Wolff cluster. Only "metropolis" runs the whole loop
+        compiled, the others step through IsingModel.mc_step().
+
+    ising : IsingModel or None
+        Model of size L to reuse (it is reset to T, and its own option is used). If 
+        None, a new one is built.
+
     Returns
     -------
     tuple(float)
-        Returns average energy, energy squared, magnetization, and magnetization
-        squared for a total (msmt_sweeps//msmt_rate) number of configurations
-        post thermalization.
+        Returns the mean and variance of the energy, then the mean and variance of
+        the magnetization, over a total ceil(msmt_sweeps/msmt_rate) number of 
+        configurations post thermalization.
     
     """
-    energy, energy_sq, magnetization, magnetization_sq = 0., 0., 0., 0.
-    n_msmts = msmt_sweeps // msmt_rate
+    if ising is None: ising = IsingModel(L, T, option=option)
+    else: ising.reset(T)
+
+    if ising.option == "metropolis":
+        # The whole sweep loop runs compiled, as a batch of one, see helper.run_sweeps_batched()
+        stats = helper.run_sweeps_batched(ising.state[None], L, ising.J, ising.prob_table[None], ising._nbrs,
+                                          ising._rng[None], thermalize_sweeps, msmt_sweeps, msmt_rate)[0]
+
+        if verbose: print(f"Done measurements for L = {L}, T = {T}!")
 
-    ising = IsingModel(L, T)
+        return stats
+
+    n_msmts = -(-msmt_sweeps // msmt_rate)   # One every msmt_rate sweeps, starting at the first
+    energy, magnetization = np.empty(n_msmts), np.empty(n_msmts)
+
+    mc_step = ising.mc_step     # Bound once, not looked up on every sweep
 
     for i in range(thermalize_sweeps):
-        ising.mc_step()
+        mc_step()
 
     if verbose: print("Done thermalizing!")
 
     for i in range(msmt_sweeps):
-        ising.mc_step()
+        mc_step()
 
         if i % msmt_rate == 0:
-            msmt_energy, msmt_magnetization = ising.energy, ising.magnetization
-
-            energy += msmt_energy
-            energy_sq += msmt_energy**2
-            magnetization += msmt_magnetization
-            magnetization_sq += msmt_magnetization**2
+            energy[i//msmt_rate], magnetization[i//msmt_rate] = ising.observables
 
     if verbose: print(f"Done measurements for L = {L}, T = {T}!")
 
-    return energy/n_msmts, energy_sq/n_msmts, magnetization/n_msmts, magnetization_sq/n_msmts
+    # np.var subtracts the mean first, so there is no E^2 - <E>^2 cancellation
+    return energy.mean(), energy.var(), magnetization.mean(), magnetization.var()
+
+def simulate_batched(thermalize_sweeps, msmt_sweeps, msmt_rate, L, T, verbose=False, ising=None):
+    """
+    Same as simulate(), but for a whole array of temperatures at once, using the 
+    Metropolis algorithm on a BatchedIsingModel.
+
+    Parameters
+    ----------
+    thermalize_sweeps, msmt_sweeps, msmt_rate, L, verbose
+        See simulate().
+
+    T : np.ndarray
+        Temperatures to simulate.
+
+    ising : BatchedIsingModel or None
+        Model of size L with T.size replicas to reuse (it is reset to T). If None, a 
+        new one is built.
+
+    Returns
+    -------
+    tuple(np.ndarray)
+        Mean and variance of the energy, and mean and variance of the magnetization,
+        for every temperature in T.
+
+    """
+    T = np.asarray(T)
+
+    if ising is None: ising = BatchedIsingModel(L, T)
+    else: ising.reset(T)
+
+    # Every replica runs its whole sweep loop compiled, see helper.run_sweeps_batched()
+    stats = helper.run_sweeps_batched(ising.state, L, ising.J, ising.prob_table, ising._nbrs, ising._rng,
+                                      thermalize_sweeps, msmt_sweeps, msmt_rate)
+
+    if verbose: print(f"Done measurements for L = {L}, {T.size} temperatures!")
+
+    return tuple(stats.T)
+
+def _init_worker():
+    """
+    Pool initializer. Every core already gets its own (L, T block) job, so keep numba
+    from also spawning a thread per core inside each worker. Then run a tiny batch, so
+    loading the compiled kernels and starting numba's threading layer happens here and
+    not in the middle of the first real job.
+    """
+    set_num_threads(1)
+    simulate_batched(1, 1, 1, 2, np.ones(1))
 
 def save(results, L):
     """
@@ -80,6 +148,7 @@ def save(results, L):
 
 
 #-----------------------------------------------------------------------------
+@helper.timer
 def main():
 
     print("")
@@ -105,7 +174,7 @@ def main():
 
     # System parameters
     sizes = [10, 16, 24, 36]
-    T = np.arange(0.015, 4.5, 0.015) 
+    T = np.linspace(0.015, 4.5, 300)   # Same grid as np.arange(0.015, 4.5, 0.015), without the float step drift
     k = 1 # Setting Boltzmann constant to 1
 
     print("Parameters")
@@ -122,21 +191,36 @@ def main():
     # Data type definitions for structured array of results
     results_dtype = [("E", float), ("M", float), ("C", float), ("Chi", float), ("T", float)]
 
+    # Every size runs its temperatures as batches of replicas, and all the (L, T block)
+    # jobs go to a single pool. Largest L first, since they take the longest, so no 
+    # core is left with a big job at the very end
+    blocks = np.array_split(np.arange(T.size), cpu_count())   # Indices into T
+    jobs = [(L, block) for L in sorted(sizes, reverse=True) for block in blocks]
+
+    print(f"Starting simulation for {len(sizes)} sizes, in {len(jobs)} batches of temperatures")
+
+    # Parallelizes process depending on how many CPU cores are available
+    # Only L and the block of temperatures are sent to the workers, each job builds its
+    # own batch of lattices. They are spawned, not forked: helper compiles its parallel kernels at import, and
+    # forking after that leaves numba's threading layer unable to shut down on exit
+    with ProcessPoolExecutor(max_workers=cpu_count(), initializer=_init_worker, mp_context=get_context("spawn")) as executor:
+        f = partial(simulate_batched, thermalize_sweeps, msmt_sweeps, msmt_rate)
+        outputs = list(executor.map(f, [L for L, _ in jobs], [T[block] for _, block in jobs]))
+
+    # <E>, Var E, <M>, Var M for every size and temperature, filled in block by block
+    stats = {L: np.empty((4, T.size)) for L in sizes}
+    for (L, block), output in zip(jobs, outputs): stats[L][:, block] = output
+
     for L in sizes:
-        print(f"Starting simulation for size L = {L}")
         N = L**2
         results = np.empty(T.size, dtype=results_dtype)   # Defines structured array to save
-
-        # Parallelizes process depending on how many CPU cores are available
-        with Pool(cpu_count()) as p:
-            f = partial(simulate, thermalize_sweeps, msmt_sweeps, msmt_rate, L)
-            energy, energy_sq, magnetization, magnetization_sq = map(np.asarray, zip(*p.map(f, T)))
+        energy, energy_var, magnetization, magnetization_var = stats[L]
 
         # Saves simulation results for analysis
         results["E"]   = energy
         results["M"]   = magnetization
-        results["C"]   = (1/(N*k*T**2))*(energy_sq - energy**2)
-        results["Chi"] = (N/(k*T))*(magnetization_sq - magnetization**2) 
+        results["C"]   = (1/(N*k*T**2))*energy_var
+        results["Chi"] = (N/(k*T))*magnetization_var
         results["T"]   = T
 
         print(f"Done simulation for L = {L}!")